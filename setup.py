@@ -39,8 +39,10 @@ SPARQLWrapper & rdflib packages''',
                          'rdflib',
                          'pygments',
                          'SPARQLWrapper', ],
-#    extras_require = {
-#        'Diagram': [ 'graphviz' ] },
+    extras_require = {
+        'fastjson': [ 'orjson' ],
+        'diagram': [ 'pygraphviz' ],
+    },
 
     entry_points = { 
         'console_scripts': 
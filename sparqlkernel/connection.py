@@ -9,11 +9,13 @@ import sys
 import io
 import re
 import json
-import datetime
+import time
 import logging
 import os.path
+import shutil
 import urllib
 from operator import itemgetter
+from itertools import islice
 
 from IPython.utils.tokenutil import token_at_cursor, line_at_cursor
 from traitlets import List
@@ -25,8 +27,13 @@ from SPARQLWrapper.Wrapper import _SPARQL_XML, _SPARQL_JSON
 from rdflib import ConjunctiveGraph, Literal
 from rdflib.parser import StringInputSource
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from .constants import DEFAULT_TEXT_LANG
-from .utils import is_collection, KrnlException, div, escape
+from .utils import is_collection, KrnlException, div, escape_many, memoize
 from .drawgraph import draw_graph
 
 # IPython.core.display.HTML
@@ -35,8 +42,20 @@ PY3 = sys.version_info[0] == 3
 if PY3:
     unicode = str
     touc = str
+    timer = time.perf_counter
 else:
     touc = lambda x: str(x).decode('utf-8', 'replace')
+    timer = time.time
+
+# Use the faster JSON parser & serializer, if available. Both parsers take
+# bytes (decoded first for the standard one, which only accepts bytes since
+# Python 3.6), and both serializers produce the same indented text
+if orjson:
+    json_loads = orjson.loads
+    json_dumps = lambda v: orjson.dumps(v, option=orjson.OPT_INDENT_2).decode('utf-8')
+else:
+    json_loads = lambda b: json.loads(b.decode('utf-8'))
+    json_dumps = lambda v: json.dumps(v, ensure_ascii=False, indent=2)
 
 
 # Valid mime types in the SPARQL response (depending on what we requested)
@@ -49,6 +68,15 @@ mime_type = {SPARQLWrapper.JSON:   set(_SPARQL_JSON),
              SPARQLWrapper.XML:    set(_SPARQL_XML)
 }
 
+# The format to render a response in, given the mime type received
+render_format = {m: fmt for fmt in (SPARQLWrapper.XML, SPARQLWrapper.N3,
+                                    SPARQLWrapper.JSON)
+                 for m in mime_type[fmt]}
+
+# Detect SPARQL query forms that return a result set or a graph
+_SELECT_RE = re.compile(r'\bselect\b', re.I)
+_DESCRIBE_CONSTRUCT_RE = re.compile(r'\b(?:describe|construct)\b', re.I)
+
 # ----------------------------------------------------------------------
 
 def cleanhtml(raw_html, ctype):
@@ -63,25 +91,42 @@ def cleanhtml(raw_html, ctype):
     return re.sub(r'[\n]+', '\n', html, flags=re.S)
 
 
-def html_elem(e, ct, withtype=False):
+# HTML templates for table rows & cells. Content cells get the escaped
+# value, the raw value and the type
+ROW_START = u'<tr class={}>'.format
+ROW_END = u'</tr>'
+HDR_CELL = u'<th>{}</th>'.format
+HDR_CELL_TYPE = u'<th>{0}</th><th>{1}</th>'.format
+URI_CELL = u'<td class=val><a href="{1}" target="_other">{0}</a></td>'.format
+VAL_CELL = u'<td class=val>{0}</td>'.format
+URI_CELL_TYPE = (u'<td class=val><a href="{1}" target="_other">{0}</a></td>'
+                 u'<td class=typ>{2}</td>').format
+VAL_CELL_TYPE = u'<td class=val>{0}</td><td class=typ>{2}</td>'.format
+
+# Element types that are rendered as links
+URI_TYPES = frozenset(('uri', 'URIRef'))
+
+
+def row_formatter(header, withtype=False):
     """
-    Format a result element as an HTML table cell.
-      @param e (list): a pair \c (value,type)
-      @param ct (str): cell type (th or td)
+    Return a function that formats a result row as HTML table cells.
+    The function is specialized for the fixed table configuration, so that
+    no decisions other than the element type are taken per cell.
+      @param header (bool): format header cells, instead of content cells
       @param withtype (bool): add an additional cell with the element type
     """
-    # Header cell
-    if ct == 'th':
-        return '<th>{0}</th><th>{1}</th>'.format(*e) if withtype else '<th>{}</th>'.format(e)
-    # Content cell
-    if e[1] in ('uri', 'URIRef'):
-        html = u'<{0} class=val><a href="{1}" target="_other">{2}</a></{0}>'.format(ct, e[0], escape(e[0]))
-    else:
-        html = u'<{0} class=val>{1}</{0}>'.format(ct, escape(e[0]))
-    # Create the optional cell for the type
-    if withtype:
-        html += u'<{0} class=typ>{1}</{0}>'.format(ct, e[1])
-    return html
+    if header:
+        cell = (lambda e: HDR_CELL_TYPE(*e)) if withtype else HDR_CELL
+        return lambda row: u'\n'.join([cell(e) for e in row])
+    uri_cell, val_cell = ((URI_CELL_TYPE, VAL_CELL_TYPE) if withtype else
+                          (URI_CELL, VAL_CELL))
+
+    def fmt(row):
+        row = tuple(row)
+        values = escape_many([e[0] for e in row])
+        return u'\n'.join([(uri_cell if e[1] in URI_TYPES else val_cell)(v, e[0], e[1])
+                           for v, e in zip(values, row)])
+    return fmt
 
 
 def html_table(data, header=True, limit=None, withtype=False):
@@ -94,9 +139,10 @@ def html_table(data, header=True, limit=None, withtype=False):
         (even/odd) or not.
       @return (int,string): a pair <number-of-rendered-rows>, <html-table>
     """
-    if header and limit:
-        limit += 1
-    ct = 'th' if header else 'td'
+    if limit:
+        data = islice(data, limit+1 if header else limit)
+    fmt_row = row_formatter(header, withtype)
+    fmt_content = row_formatter(False, withtype)
     rc = 'hdr' if header else 'odd'
 
     # import codecs
@@ -108,54 +154,67 @@ def html_table(data, header=True, limit=None, withtype=False):
     #         for n, c in enumerate(row):
     #             print( type(c), repr(c), file=f )
 
-    html = u'<table>'
+    parts = [u'<table>']
     rn = -1
     for rn, row in enumerate(data):
-        html += u'<tr class={}>'.format(rc)
-        html += '\n'.join((html_elem(c, ct, withtype) for c in row))
-        html += u'</tr>'
+        parts.append(ROW_START(rc))
+        parts.append(fmt_row(row))
+        parts.append(ROW_END)
         rc = 'even' if rc == 'odd' else 'odd'
-        ct = 'td'
-        if limit:
-            limit -= 1
-            if not limit:
-                break
-    return (0, '') if rn < 0 else (rn+1-header, html+u'</table>')
+        fmt_row = fmt_content
+    if rn < 0:
+        return 0, ''
+    parts.append(u'</table>')
+    return rn+1-header, u''.join(parts)
 
 
 # ----------------------------------------------------------------------
 
-def jtype(c):
+@memoize(256)
+def literal_type(name, lang):
     """
-    Return the a string with the data type of a value, for JSON data
+    Return the a string with the data type of a literal value with a given
+    language. Results use very few different languages, so labels are cached
     """
-    ct = c['type']
-    return ct if ct != 'literal' else '{}, {}'.format(ct, c.get('xml:lang'))
+    return u'{}, {}'.format(name, lang)
 
 
-def gtype(n):
+class JsonTypeLabels(dict):
     """
-    Return the a string with the data type of a value, for Graph data
+    The data type labels of JSON values, indexed by (type, language) pairs.
+    A label is built the first time its pair is looked up
     """
-    t = type(n).__name__
-    return str(t) if t != 'Literal' else 'Literal, {}'.format(n.language)
+    def __missing__(self, key):
+        ct, lang = key
+        label = self[key] = ct if ct != 'literal' else literal_type(ct, lang)
+        return label
 
 
 def lang_match_json(row, hdr, accepted_languages):
     '''Find if the JSON row contains acceptable language data'''
     if not accepted_languages:
         return True
-    languages = set([row[c].get('xml:lang') for c in hdr
-                     if c in row and row[c]['type'] == 'literal'])
-    return (not languages) or (languages & accepted_languages)
+    has_literal = False
+    for c in hdr:
+        cell = row.get(c)
+        if cell is not None and cell['type'] == 'literal':
+            if cell.get('xml:lang') in accepted_languages:
+                return True
+            has_literal = True
+    return not has_literal
 
 
 def lang_match_rdf(triple, accepted_languages):
     '''Find if the RDF triple contains acceptable language data'''
     if not accepted_languages:
         return True
-    languages = set([n.language for n in triple if isinstance(n, Literal)])
-    return (not languages) or (languages & accepted_languages)
+    has_literal = False
+    for n in triple:
+        if isinstance(n, Literal):
+            if n.language in accepted_languages:
+                return True
+            has_literal = True
+    return not has_literal
 
 
 XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
@@ -172,19 +231,103 @@ def lang_match_xml(row, accepted_languages):
     return (not column_languages) or (column_languages & accepted_languages)
 
 
+# Parts of a query that must not be inspected when looking for keywords
+_QUERY_MASK_RE = re.compile(r"'''.*?'''|" r'""".*?"""|'         # long strings
+                            r"'(?:[^'\\\n]|\\.)*'|"             # strings
+                            r'"(?:[^"\\\n]|\\.)*"|'
+                            r'<[^<>"{}|^`\\\s]*>|'              # IRIs
+                            r'#[^\n]*',                         # comments
+                            re.S)
+
+_QUERY_FORM_RE = re.compile(r'\b(?:select|construct|describe|ask)\b', re.I)
+_GROUPING_RE = re.compile(r'\b(?:group\s+by|having)\b', re.I)
+
+
+def mask_query(query):
+    '''
+    Return a copy of a query with its strings, IRIs & comments blanked out,
+    keeping all other characters at the same positions
+    '''
+    return _QUERY_MASK_RE.sub(lambda m: ' '*len(m.group()), query)
+
+
+def lang_filter_query(query, accepted_languages):
+    """
+    Rewrite a SELECT query so that the endpoint itself discards the rows
+    that the language filter would drop afterwards.
+    A FILTER clause is added to the outermost WHERE group, keeping rows
+    in which no projected variable is a language-tagged literal, or at least
+    one of them matches an accepted language.
+    Only simple queries are rewritten (explicit variable list, no
+    subqueries, no grouping); since the client-side filter is still applied
+    on the results, the added FILTER only needs to be a superset of it.
+      @param query (str): the SPARQL query
+      @param accepted_languages (list): the accepted language tags
+      @return (str): the rewritten query, or None if it cannot be rewritten
+    """
+    if not all(re.match(r'^[A-Za-z0-9-]+$', l) for l in accepted_languages):
+        return None
+    # Work on a copy with strings, IRIs & comments blanked out
+    masked = mask_query(query)
+    forms = _QUERY_FORM_RE.findall(masked)
+    if len(forms) != 1 or forms[0].lower() != 'select' or \
+       _GROUPING_RE.search(masked):
+        return None
+
+    # Find the projected variables
+    start = _QUERY_FORM_RE.search(masked).end()
+    open_brace = masked.find('{', start)
+    if open_brace < 0:
+        return None
+    projection = masked[start:open_brace]
+    if '(' in projection or '*' in projection:
+        return None
+    variables = re.findall(r'[?$](\w+)', projection)
+    if not variables:
+        return None
+
+    # Find the end of the WHERE group
+    depth = 0
+    for pos in range(open_brace, len(masked)):
+        if masked[pos] == '{':
+            depth += 1
+        elif masked[pos] == '}':
+            depth -= 1
+            if not depth:
+                break
+    else:
+        return None
+
+    # Untagged (plain or typed) literals are not dropped by the client filter
+    no_literal = ' && '.join('(!bound(?{0}) || !isLiteral(?{0}) || '
+                             'lang(?{0}) = "")'.format(v) for v in variables)
+    lang_match = ' || '.join('langMatches(lang(?{}), "{}")'.format(v, l)
+                             for v in variables for l in accepted_languages)
+    return u'{}\nFILTER ( ({}) || {} )\n{}'.format(query[:pos], no_literal,
+                                                   lang_match, query[pos:])
+
+
+# Element for a missing value in a result row
+EMPTY_CELL = ('', '')
+
+
 def json_iterator(hdr, rowlist, lang, add_vtype=False):
     """
     Convert a JSON response into a double iterable, by rows and columns
     Optionally add element type, and filter triples by language (on literals)
     """
     # Return the header row
-    yield hdr if not add_vtype else ((h, 'type') for h in hdr)
+    yield hdr if not add_vtype else [(h, 'type') for h in hdr]
     # Now the data rows
+    getval = itemgetter('value')
+    gettype = itemgetter('type')
+    labels = JsonTypeLabels()
     for row in rowlist:
         if lang and not lang_match_json(row, hdr, lang):
             continue
-        yield ((row[c]['value'], jtype(row[c])) if c in row else ('', '')
-               for c in hdr)
+        yield [EMPTY_CELL if cell is None else
+               (getval(cell), labels[gettype(cell), cell.get('xml:lang')])
+               for cell in map(row.get, hdr)]
 
 
 def rdf_iterator(graph, lang, add_vtype=False):
@@ -194,19 +337,22 @@ def rdf_iterator(graph, lang, add_vtype=False):
     """
     # Return the header row
     hdr = ('subject', 'predicate', 'object')
-    yield hdr if not add_vtype else ((h, 'type') for h in hdr)
+    yield hdr if not add_vtype else [(h, 'type') for h in hdr]
     # Now the data rows
+    literal = Literal
     for row in graph:
         if lang and not lang_match_rdf(row, lang):
             continue
-        yield ((unicode(c), gtype(c)) for c in row)
+        yield [(unicode(c), type(c).__name__) if type(c) is not literal else
+               (unicode(c), literal_type('Literal', c.language))
+               for c in row]
 
 
 def render_json(result, cfg, **kwargs):
     """
     Render to output a result in JSON format
     """
-    result = json.loads(result.decode('utf-8'))
+    result = json_loads(result)
     head = result['head']
     if 'results' not in result:
         if 'boolean' in result:
@@ -225,9 +371,7 @@ def render_json(result, cfg, **kwargs):
         data += div('Total: {}, Shown: {}', nrow, n, css="tinfo")
         data = {'text/html': div(data)}
     else:
-        result = json.dumps(result,
-                            ensure_ascii=False, indent=2, sort_keys=True)
-        data = {'text/plain': unicode(result)}
+        data = {'text/plain': unicode(json_dumps(result))}
 
     return {'data': data,
             'metadata': {}}
@@ -289,30 +433,57 @@ def render_xml(result, cfg, **kwargs):
             'metadata': {}}
 
 
+# Mapping from MIME types to formats accepted by RDFlib
+rdflib_formats = {'text/rdf+n3': 'n3',
+                  'text/turtle': 'turtle',
+                  'application/x-turtle': 'turtle',
+                  'application/rdf+xml': 'xml',
+                  'text/rdf': 'xml'
+                  }
+
+
+# An N3/Turtle document that contains no statements: only whitespace,
+# comments and complete prefix/base directives (Turtle & SPARQL style)
+_GRAPH_NOSTMT_RE = re.compile(r'''(?: \s | \#[^\n]* (?:\n|\Z)
+                                 | @prefix \s+ [^\s:]*: \s* <[^>]*> \s* \.
+                                 | @base \s* <[^>]*> \s* \.
+                                 | prefix \s+ [^\s:]*: \s* <[^>]*>
+                                 | base \s* <[^>]*> )* \Z''',
+                              re.I | re.X)
+
+
+def is_empty_graph(data):
+    '''
+    Find if an N3/Turtle document contains no statements, i.e. only
+    prefix/base declarations, comments or whitespace
+    '''
+    return _GRAPH_NOSTMT_RE.match(data) is not None
+
+
 def render_graph(result, cfg, **kwargs):
     """
     Render to output a result that can be parsed as an RDF graph
     """
-    # Mapping from MIME types to formats accepted by RDFlib
-    rdflib_formats = {'text/rdf+n3': 'n3',
-                      'text/turtle': 'turtle',
-                      'application/x-turtle': 'turtle',
-                      'text/turtle': 'turtle',
-                      'application/rdf+xml': 'xml',
-                      'text/rdf': 'xml'
-                      }
-
-
     try:
         got = kwargs.get('format', 'text/rdf+n3')
         fmt = rdflib_formats[got]
     except KeyError:
         raise KrnlException('Unsupported format for graph processing: {!s}', got)
 
+    # Raw display of N3/Turtle: show the data as received, no need to parse it
+    display = cfg.dis[0] if is_collection(cfg.dis) else cfg.dis
+    if display not in ('png', 'svg', 'table') and fmt != 'xml':
+        data = result.decode('utf-8', 'replace') if isinstance(result, bytes) else result
+        if is_empty_graph(data):
+            data = {'text/html': div(div('empty graph', css='krn-warn'))}
+        else:
+            data = {'text/plain': data}
+        return {'data': data,
+                'metadata': {}}
+
     g = ConjunctiveGraph()
     g.load(StringInputSource(result), format=fmt)
 
-    display = cfg.dis[0] if is_collection(cfg.dis) else cfg.dis
     if display in ('png', 'svg'):
         try:
             literal = len(cfg.dis) > 1 and cfg.dis[1].startswith('withlit')
@@ -322,16 +493,20 @@ def render_graph(result, cfg, **kwargs):
                     'metadata': metadata}
         except Exception as e:
             raise KrnlException('Exception while drawing graph: {!r}', e)
-    elif display == 'table':
+
+    ntriples = len(g)
+    if display == 'table':
         it = rdf_iterator(g, set(cfg.lan), add_vtype=cfg.typ)
         n, data = html_table(it, limit=cfg.lmt, withtype=cfg.typ)
         data += div('Shown: {}, Total rows: {}', n if cfg.lmt else 'all',
-                    len(g), css="tinfo")
+                    ntriples, css="tinfo")
         data = {'text/html': div(data)}
-    elif len(g) == 0:
+    elif ntriples == 0:
         data = {'text/html': div(div('empty graph', css='krn-warn'))}
     else:
-        data = {'text/plain': g.serialize(format='nt').decode('utf-8')}
+        buf = io.BytesIO()
+        g.serialize(destination=buf, format='nt', encoding='utf-8')
+        data = {'text/plain': buf.getvalue().decode('utf-8', 'replace')}
 
     return {'data': data,
             'metadata': {}}
@@ -364,9 +539,21 @@ class SparqlConnection(object):
         self.log = logger or logging.getLogger(__name__)
         self.srv = None
         self.log.info("START")
-        self.cfg = CfgStruct(hdr=[], pfx={}, lmt=20, fmt=None, out=None, aut=None,
-                             grh=None, dis='table', typ=False, lan=[], par={},
-                             mth='GET', hhr=KeyCaseInsensitiveDict(), ept=None)
+        # (pfb caches the PREFIX lines for pfx; reset it when pfx changes)
+        self.cfg = CfgStruct(hdr=[], pfx={}, pfb=None, lmt=20, fmt=None,
+                             out=None, aut=None, grh=None, dis='table',
+                             typ=False, lan=[], par={}, mth='GET',
+                             hhr=KeyCaseInsensitiveDict(), ept=None)
+
+
+    def _outfile_name(self, num):
+        """
+        Return the name of the file to save the raw result of a query
+        """
+        try:
+            return self.cfg.out % num
+        except TypeError:
+            return self.cfg.out
 
 
     def query(self, query, num=0, silent=False):
@@ -380,11 +567,18 @@ class SparqlConnection(object):
         elif self.srv is None or self.srv.endpoint != self.cfg.ept:
             self.srv = SPARQLWrapper.SPARQLWrapper(self.cfg.ept)
 
+        # If the result will be filtered by language, let the endpoint do it.
+        # Not when saving to a file, which must hold the unfiltered result
+        if self.cfg.lan and self.cfg.dis == 'table' and \
+           self.cfg.fmt in (True, SPARQLWrapper.JSON) and not self.cfg.out:
+            query = lang_filter_query(query, self.cfg.lan) or query
+
         # Add to the query all predefined SPARQL prefixes
         if self.cfg.pfx:
-            prefix = '\n'.join(('PREFIX {} {}'.format(*v)
-                                for v in self.cfg.pfx.items()))
-            query = prefix + '\n' + query
+            if self.cfg.pfb is None:
+                self.cfg.pfb = ''.join(['PREFIX {} {}\n'.format(*v)
+                                        for v in self.cfg.pfx.items()])
+            query = self.cfg.pfb + query
 
         # Prepend to the query all predefined Header entries
         # The header should be before the prefix and other sparql commands
@@ -400,12 +594,21 @@ class SparqlConnection(object):
             fmt_req = False
         elif self.cfg.fmt is not True:
             fmt_req = self.cfg.fmt
-        elif re.search(r'\bselect\b', query, re.I):
-            fmt_req = SPARQLWrapper.JSON
-        elif re.search(r'\b(?:describe|construct)\b', query, re.I):
-            fmt_req = SPARQLWrapper.N3
         else:
-            fmt_req = False
+            # Look for the form keyword outside strings, IRIs & comments.
+            # Queries without prologue start with it
+            masked = mask_query(query)
+            start = masked.lstrip()[:10].lower()
+            if start.startswith('select'):
+                fmt_req = SPARQLWrapper.JSON
+            elif start.startswith(('construct', 'describe')):
+                fmt_req = SPARQLWrapper.N3
+            elif _SELECT_RE.search(masked):
+                fmt_req = SPARQLWrapper.JSON
+            elif _DESCRIBE_CONSTRUCT_RE.search(masked):
+                fmt_req = SPARQLWrapper.N3
+            else:
+                fmt_req = False
 
         # Set the query
         self.srv.resetQuery()
@@ -430,73 +633,77 @@ class SparqlConnection(object):
 
         self.srv.setQuery(query)
 
-        if not silent or self.cfg.out:
-            try:
-                # Launch query
-                start = datetime.datetime.utcnow()
-                res = self.srv.query()
-                now = datetime.datetime.utcnow()
-                self.log.debug(u'response elapsed=%s', now-start)
-                start = now
-
-                # See what we got
-                info = res.info()
-                self.log.debug(u'response info: %s', info)
-                fmt_got = info['content-type'].split(';')[0] if 'content-type' in info else None
-
-                # Check we received a MIME type according to what we requested
-                if fmt_req not in (True, False, None) and fmt_got not in mime_type[fmt_req]:
-                    raise KrnlException(u'Unexpected response format: {} (requested: {})', fmt_got, fmt_req)
-
-                # Get the result
-                data = b''.join((line for line in res))
-
-            except KrnlException:
-                raise
-            except SPARQLWrapperException as e:
-                raise KrnlException(u'SPARQL error: {}', touc(e))
-            except urllib.error.HTTPError as e:
-                msg = e.read()
-                ctype = e.headers.get('Content-Type', 'text/plain')
-                if ctype.startswith('text/html'):
-                    msg = cleanhtml(msg, ctype)
-                raise KrnlException(u'HTTP error: {} {}: {}', e.code, e.reason,
-                                    msg)
-            except Exception as e:
-                raise KrnlException(u'Query processing error: {!s}', e)
-
-            # Write the raw result to a file
-            if self.cfg.out:
-                try:
-                    outname = self.cfg.out % num
-                except TypeError:
-                    outname = self.cfg.out
-                with io.open(outname, 'wb') as f:
-                    f.write(data)
-
-            # Render the result into the desired display format
-            try:
-                # Data format we will render
-                fmt = (fmt_req if fmt_req else
-                       SPARQLWrapper.JSON if fmt_got in mime_type[SPARQLWrapper.JSON] else
-                       SPARQLWrapper.N3 if fmt_got in mime_type[SPARQLWrapper.N3] else
-                       SPARQLWrapper.XML if fmt_got in mime_type[SPARQLWrapper.XML] else
-                       'text/plain' if self.cfg.dis == 'raw' else
-                       fmt_got if fmt_got in ('text/plain', 'text/html') else
-                       'text/plain')
-                #self.log.debug(u'format: req=%s got=%s rend=%s',fmt_req,fmt_got,fmt)
-
-                # Can't process? Just write the data as is
-                if fmt in ('text/plain', 'text/html'):
-                    out = data.decode('utf-8') if isinstance(data, bytes) else data
-                    r = {'data': {fmt: out}, 'metadata': {}}
-                else:
-                    f = render_json if fmt == SPARQLWrapper.JSON else render_xml if fmt == SPARQLWrapper.XML else render_graph
-                    r = f(data, self.cfg, format=fmt_got)
-                    now = datetime.datetime.utcnow()
-                    self.log.debug(u'response formatted=%s', now-start)
-                if not silent:
-                    return r
-
-            except Exception as e:
-                raise KrnlException(u'Response processing error: {}', touc(e))
+        # Nothing to do if the result is neither to be shown nor saved
+        if silent and not self.cfg.out:
+            return
+
+        # Only measure times if they are going to be logged
+        timed = self.log.isEnabledFor(logging.DEBUG)
+        try:
+            # Launch query
+            if timed:
+                t0 = timer()
+            res = self.srv.query()
+            if timed:
+                t1 = timer()
+                self.log.debug(u'response elapsed=%.3fs', t1-t0)
+                t0 = t1
+
+            # See what we got
+            info = res.info()
+            self.log.debug(u'response info: %s', info)
+            fmt_got = info['content-type'].split(';')[0] if 'content-type' in info else None
+
+            # Check we received a MIME type according to what we requested
+            if fmt_req not in (True, False, None) and fmt_got not in mime_type[fmt_req]:
+                raise KrnlException(u'Unexpected response format: {} (requested: {})', fmt_got, fmt_req)
+
+            # If the result is only to be saved, stream it to the file.
+            # Else get it in a single read from the HTTP response
+            if silent:
+                with io.open(self._outfile_name(num), 'wb') as f:
+                    shutil.copyfileobj(res.response, f, 65536)
+                return
+            data = res.response.read()
+
+        except KrnlException:
+            raise
+        except SPARQLWrapperException as e:
+            raise KrnlException(u'SPARQL error: {}', touc(e))
+        except urllib.error.HTTPError as e:
+            msg = e.read()
+            ctype = e.headers.get('Content-Type', 'text/plain')
+            if ctype.startswith('text/html'):
+                msg = cleanhtml(msg, ctype)
+            raise KrnlException(u'HTTP error: {} {}: {}', e.code, e.reason,
+                                msg)
+        except Exception as e:
+            raise KrnlException(u'Query processing error: {!s}', e)
+
+        # Write the raw result to a file
+        if self.cfg.out:
+            with io.open(self._outfile_name(num), 'wb') as f:
+                f.write(data)
+
+        # Render the result into the desired display format
+        try:
+            # Data format we will render
+            fmt = (fmt_req or render_format.get(fmt_got) or
+                   ('text/plain' if self.cfg.dis == 'raw' else
+                    fmt_got if fmt_got in ('text/plain', 'text/html') else
+                    'text/plain'))
+            #self.log.debug(u'format: req=%s got=%s rend=%s',fmt_req,fmt_got,fmt)
+
+            # Can't process? Just write the data as is
+            if fmt in ('text/plain', 'text/html'):
+                out = data.decode('utf-8') if isinstance(data, bytes) else data
+                r = {'data': {fmt: out}, 'metadata': {}}
+            else:
+                f = render_json if fmt == SPARQLWrapper.JSON else render_xml if fmt == SPARQLWrapper.XML else render_graph
+                r = f(data, self.cfg, format=fmt_got)
+                if timed:
+                    self.log.debug(u'response formatted=%.3fs', timer()-t0)
+            return r
+
+        except Exception as e:
+            raise KrnlException(u'Response processing error: {}', touc(e))
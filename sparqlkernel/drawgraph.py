@@ -101,11 +101,16 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import errno
 import base64
-import re
 from io import StringIO
+from collections import defaultdict
 
 import rdflib
 
+try:
+    import pygraphviz
+except ImportError:
+    pygraphviz = None
+
 from .utils import escape
 
 import logging
@@ -113,10 +118,10 @@ LOG = logging.getLogger(__name__)
 
 # ------------------------------------------------------------------------
 
+# The properties holding labels, in order of preference
 LABEL_PROPERTIES = [
     rdflib.RDFS.label,
     rdflib.URIRef('http://schema.org/name'),
-    rdflib.URIRef('http://www.w3.org/2000/01/rdf-schema#label'),
     rdflib.URIRef('http://www.w3.org/2004/02/skos/core#prefLabel'),
     rdflib.URIRef("http://purl.org/dc/elements/1.1/title"),
     rdflib.URIRef("http://xmlns.com/foaf/0.1/name"),
@@ -124,43 +129,83 @@ LABEL_PROPERTIES = [
     rdflib.URIRef("http://www.w3.org/2006/vcard/ns#org"),
 ]
 
+PROP_RANK = {p: n for n, p in enumerate(LABEL_PROPERTIES)}
+
 
 
+def label_index(gr):
+    '''
+      @param gr (Graph): RDF graph
+      @return (dict): a dict of {entity: [(property, label), ...]} with all
+        the labels in the graph
 
-def label(x, gr, preferred_languages=None):
+    Collect all labels in a single sweep over the label properties, so that
+    they need not be looked up in the graph again for each node
+    '''
+    index = defaultdict(list)
+    for s, p, l in gr.triples_choices((None, LABEL_PROPERTIES, None)):
+        index[s].append((p, l))
+    return index
+
+
+def label(x, gr, preferred_languages=None, index=None):
     '''
       @param x: graph entity
       @param gr (Graph): RDF graph
       @param preferred_languages (iterable): list of preferred language codes for
         the labels.
+      @param index (dict): an optional label index, as built by label_index()
 
     Return the best available label in the graph for the passed entity.
-    If a set of preferred languages is given, try them in order. If none is
-    found, an arbitrary language will be chosen
+    Labels are ranked first by language: the preferred languages in order,
+    then "mul", then labels with no language, then any other language.
+    Within the same language rank, the order of LABEL_PROPERTIES decides.
     '''
-    # Find all labels & their language
-    labels = {l.language: l
-              for labelProp in LABEL_PROPERTIES
-              for l in gr.objects(x, labelProp)}
+    # Find all labels & their property
+    if index is not None:
+        labels = index.get(x)
+    else:
+        labels = [(p, l) for _, p, l in
+                  gr.triples_choices((x, LABEL_PROPERTIES, None))]
     #LOG.debug("LABELS %s %s", labels, preferred_languages)
-    #return repr(preferred_languages) + repr(labels)
     if labels:
-        # Search the preferred language
-        if preferred_languages is not None:
-            for l in preferred_languages:
-                if l in labels:
-                    return labels[l]
-        # If not found, return an arbitrary language
-        return labels.popitem()[1]
+        # Select the best (language, property) rank in a single scan
+        lang_rank = {}
+        for l in preferred_languages or ():
+            lang_rank.setdefault(l, len(lang_rank))
+        n = len(lang_rank)
+        lang_rank.setdefault('mul', n)
+        lang_rank.setdefault(None, n+1)
+        return min(labels, key=lambda pl: (
+            lang_rank.get(getattr(pl[1], 'language', None), n+2),
+            PROP_RANK[pl[0]]))[1]
 
     # No labels available. Try to generate a QNAME, or else, the string itself
     try:
         return gr.namespace_manager.compute_qname(x)[2].replace('_', ' ')
     except Exception:
         # Attempt to extract the trailing part of an URI
-        m = re.search('([^/]+)$', x)
-        return m.group(1).replace('_', ' ') if m else x
+        tail = x.rsplit('/', 1)[-1]
+        return tail.replace('_', ' ') if tail else x
+
+
+
+# The RDF terms that become graph nodes
+NODE_TYPES = frozenset((rdflib.URIRef, rdflib.BNode))
 
+# DOT templates for the graph elements
+DOT_START = u'digraph { \n node [ fontname="DejaVu Sans,Tahoma,Geneva,sans-serif" ] ; \n'
+DOT_END = u'}\n'
+DOT_NODE_COMMENT = u"# %s %s\n"
+DOT_NODE_URI = u'%s [ shape=none, fontsize=10, fontcolor=%s, label="%s", href="%s", target=_other ] \n'
+DOT_NODE = u'%s [ shape=none, fontsize=10, fontcolor=%s, label="%s" ] \n'
+# Edge lines are joined from fragments, which is faster than formatting
+DOT_EDGE_START = u'\t'
+DOT_EDGE_ARROW = u' -> '
+DOT_EDGE_ATTRS = u' [ arrowhead="open", color="#9FC9E560", fontsize=9, fontcolor="#204080", label="'
+DOT_EDGE_HREF = u'", href="'
+DOT_EDGE_END_URI = u'", target="_other" ] ;\n'
+DOT_EDGE_END = u'" ] ;\n'
 
 
 def rdf2dot(g, stream, opts={}):
@@ -172,39 +217,53 @@ def rdf2dot(g, stream, opts={}):
 
     accept_lang = opts.get('lang', [])
     do_literal = opts.get('literal')
+    labels = label_index(g)
     nodes = {}
+    node_lines = [DOT_START]
+    edge_lines = []
 
     def node_id(x):
-        if x not in nodes:
-            nodes[x] = "node%d" % len(nodes)
-        return nodes[x]
+        n = nodes.get(x)
+        if n is None:
+            # New node: write its declaration right away
+            n = nodes[x] = "node%d" % len(nodes)
+            lbl = escape(label(x, g, accept_lang, labels), True)
+            if isinstance(x, rdflib.URIRef):
+                opstr = DOT_NODE_URI % (n, 'blue', lbl, x)
+            else:
+                opstr = DOT_NODE % (n, 'black', lbl)
+            node_lines.append(DOT_NODE_COMMENT % (x, n))
+            node_lines.append(opstr)
+        return n
+
+    qnames = {}
 
     def qname(x, g):
-        try:
-            q = g.compute_qname(x)
-            return q[0] + ":" + q[2]
-        except Exception:
-            return x
-
-    def accept(node):
-        if isinstance(node, (rdflib.URIRef, rdflib.BNode)):
-            return True
-        if not do_literal:
-            return False
-        return (not accept_lang) or (node.language in accept_lang)
-
-
-    stream.write(u'digraph { \n node [ fontname="DejaVu Sans,Tahoma,Geneva,sans-serif" ] ; \n')
-
-    # Write all edges. In the process make a list of all nodes
+        # Predicates repeat a lot, so keep the computed qnames
+        q = qnames.get(x)
+        if q is None:
+            try:
+                q = g.compute_qname(x)
+                q = q[0] + ":" + q[2]
+            except Exception:
+                q = x
+            qnames[x] = q
+        return q
+
+
+    # Collect all edges & nodes in a single pass over the graph
+    add_edge = edge_lines.append
+    join = u''.join
     for s, p, o in g:
         # skip triples for labels
         if p == rdflib.RDFS.label:
             continue
 
         # Create a link if both objects are graph nodes
-        # (or, if literals are also included, if their languages match)
-        if not (accept(s) and accept(o)):
+        # (or, if literals are also included, if their languages match).
+        # Subjects are always graph nodes, so only the object is checked
+        if type(o) not in NODE_TYPES and \
+           (not do_literal or (accept_lang and o.language not in accept_lang)):
             continue
 
         # add the nodes to the list
@@ -214,22 +273,17 @@ def rdf2dot(g, stream, opts={}):
         # add the link
         q = qname(p, g)
         if isinstance(p, rdflib.URIRef):
-            opstr = u'\t%s -> %s [ arrowhead="open", color="#9FC9E560", fontsize=9, fontcolor="#204080", label="%s", href="%s", target="_other" ] ;\n' % (sn, on, q, p)
-        else:
-            opstr = u'\t%s -> %s [ arrowhead="open", color="#9FC9E560", fontsize=9, fontcolor="#204080", label="%s" ] ;\n' % (sn, on, q)
-        stream.write(opstr)
-
-    # Write all nodes
-    for u, n in nodes.items():
-        lbl = escape(label(u, g, accept_lang), True)
-        if isinstance(u, rdflib.URIRef):
-            opstr = u'%s [ shape=none, fontsize=10, fontcolor=%s, label="%s", href="%s", target=_other ] \n' % (n, 'blue', lbl, u)
+            opstr = (DOT_EDGE_START, sn, DOT_EDGE_ARROW, on, DOT_EDGE_ATTRS,
+                     q, DOT_EDGE_HREF, p, DOT_EDGE_END_URI)
         else:
-            opstr = u'%s [ shape=none, fontsize=10, fontcolor=%s, label="%s" ] \n' % (n, 'black', lbl)
-        stream.write(u"# %s %s\n" % (u, n))
-        stream.write(opstr)
+            opstr = (DOT_EDGE_START, sn, DOT_EDGE_ARROW, on, DOT_EDGE_ATTRS,
+                     q, DOT_EDGE_END)
+        add_edge(join(opstr))
 
-    stream.write(u'}\n')
+    # Write all nodes, then all edges, in a single call
+    node_lines.extend(edge_lines)
+    node_lines.append(DOT_END)
+    stream.write(u''.join(node_lines))
 
 
 # ------------------------------------------------------------------------
@@ -238,16 +292,35 @@ EPIPE  = getattr(errno, 'EPIPE', 0)
 EINVAL = getattr(errno, 'EINVAL', 0)
 
 
+def run_dot_inprocess(code, fmt='svg', gv_options=[], prg='dot'):
+    '''
+    Run GraphViz on the buffer holding the graph, through the GraphViz
+    libraries loaded in-process by pygraphviz, avoiding the launch of a
+    process per graph
+    '''
+    LOG.debug("rundot (in-process) fmt=%s options=%s", fmt, gv_options)
+    try:
+        graph = pygraphviz.AGraph(string=code)
+        return graph.draw(format=fmt, prog=prg, args=' '.join(gv_options))
+    except Exception as e:
+        raise RuntimeError(u'dot exited with error:\n{0}'.format(e))
+
+
 def run_dot(code, fmt='svg', gv_options=[], **kwargs):
     '''
-    Run GraphViz on the buffer holding the graph
+    Run GraphViz on the buffer holding the graph. If pygraphviz is
+    available it is used in-process; else a GraphViz process is launched
     '''
+    prg = kwargs.get('prg', 'dot')
+    if pygraphviz is not None:
+        return run_dot_inprocess(code, fmt, gv_options, prg)
+
     LOG.debug("rundot fmt=%s options=%s", fmt, gv_options)
     # mostly copied from sphinx.ext.graphviz.render_dot
     import os
     from subprocess import Popen, PIPE
 
-    dot_args = [kwargs.get('prg', 'dot')] + gv_options + ['-T', fmt]
+    dot_args = [prg] + gv_options + ['-T', fmt]
     if os.name == 'nt':
         # Avoid opening shell window.
         # * https://github.com/tkf/ipython-hierarchymagic/issues/1
@@ -293,7 +366,7 @@ def draw_graph(g, fmt='svg', prg='dot', options={}):
 
     gv_options = options.get('graphviz', [])
     if fmt == 'png':
-        gv_options += ['-Gdpi=220', '-Gsize=25,10!']
+        gv_options = gv_options + ['-Gdpi=220', '-Gsize=25,10!']
         metadata = {"width": 5500, "height": 2200, "unconfined": True}
 
     #import codecs
@@ -301,7 +374,7 @@ def draw_graph(g, fmt='svg', prg='dot', options={}):
     #    f.write( buf.getvalue() )
 
     # Now use Graphviz to generate the graph
-    image = run_dot(buf.getvalue(), fmt=fmt, options=gv_options, prg=prg)
+    image = run_dot(buf.getvalue(), fmt=fmt, gv_options=gv_options, prg=prg)
 
     #with open('/tmp/sparqlkernel-img.'+fmt,'w') as f:
     #    f.write( image )
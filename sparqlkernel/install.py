@@ -11,7 +11,17 @@ import os
 import os.path
 import json
 import pkgutil
-import io
+import re
+import shutil
+try:
+    from importlib.resources import files as resource_files
+except ImportError:
+    resource_files = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from jupyter_client.kernelspecapp  import InstallKernelSpec, RemoveKernelSpec
 from traitlets import Unicode
@@ -25,9 +35,15 @@ PY3 = sys.version_info[0] == 3
 if PY3:
     unicode = str
 
+# Atomic rename, also overwriting the destination in Windows
+replace = getattr(os, 'replace', os.rename)
+
 MODULEDIR = os.path.dirname(__file__)
 PKGNAME = os.path.basename( MODULEDIR )
 
+# Package folder for resources. pkgutil resource names always use '/'
+RESDIR = 'resources/'
+
 
 # The kernel specfile
 kernel_json = {
@@ -49,12 +65,19 @@ def css_frame_prefix( name ):
 
 def copyresource( resource, filename, destdir ):
     """
-    Copy a resource file to a destination
+    Copy a resource file to a destination. If possible, stream it instead
+    of loading it in memory
     """
-    data = pkgutil.get_data(resource, os.path.join('resources',filename) )
-    #log.info( "Installing %s", os.path.join(destdir,filename) )
-    with open( os.path.join(destdir,filename), 'wb' ) as fp:
-        fp.write(data)
+    dest = os.path.join(destdir,filename)
+    #log.info( "Installing %s", dest )
+    if resource_files is None:
+        data = pkgutil.get_data(resource, RESDIR + filename )
+        with open( dest, 'wb' ) as fp:
+            fp.write(data)
+        return
+    src = resource_files(resource) / 'resources' / filename
+    with src.open('rb') as fin, open( dest, 'wb' ) as fout:
+        shutil.copyfileobj( fin, fout, 65536 )
 
 
 def install_kernel_resources( destdir, resource=PKGNAME, files=None ):
@@ -70,41 +93,48 @@ def install_kernel_resources( destdir, resource=PKGNAME, files=None ):
             sys.stderr.write(str(e))
 
 
+def strip_css_frame( data, prefix ):
+    '''
+    Remove all kernel CSS frames from an encoded custom.css buffer, with a
+    single regex pass
+      @return (tuple): the buffer without the frames, and the number of
+        frames removed
+    '''
+    start_marker = re.escape( (prefix + u'START').encode('utf-8') )
+    end_marker = re.escape( (prefix + u'END').encode('utf-8') )
+    frame = re.compile( start_marker + br'.*?(?:' + end_marker +
+                        br'[^\n]*(?:\n|\Z)|\Z)', re.S )
+    return frame.subn( b'', data )
+
+
 def install_custom_css( destdir, cssfile, resource=PKGNAME ):
     """
     Add the kernel CSS to custom.css
     """
     ensure_dir_exists( destdir )
     custom = os.path.join( destdir, 'custom.css' )
+    custom_new = custom + '-new'
     prefix = css_frame_prefix(resource)
 
-    # Check if custom.css already includes it. If so, let's remove it first
-    exists = False
+    # Read the current custom.css. If it already includes the kernel CSS,
+    # remove it first
+    old = b''
     if os.path.exists( custom ):
-        with io.open(custom) as f:
-            for line in f:
-                if line.find( prefix ) >= 0:
-                    exists = True
-                    break
-    if exists:
-        remove_custom_css( destdir, resource )
+        with open( custom, 'rb' ) as fin:
+            old = strip_css_frame( fin.read(), prefix )[0]
 
     # Fetch the CSS file
     cssfile += '.css'
-    data = pkgutil.get_data( resource, os.path.join('resources',cssfile) )
+    data = pkgutil.get_data( resource, RESDIR + cssfile )
     # get_data() delivers encoded data, str (Python2) or bytes (Python3)
 
-    # Add the CSS at the beginning of custom.css
-    # io.open uses unicode strings (unicode in Python2, str in Python3)
-    with io.open(custom + '-new', 'wt', encoding='utf-8') as fout:
-        fout.write( u'{}START ======================== */\n'.format(prefix))
-        fout.write( data.decode('utf-8') )
-        fout.write( u'{}END ======================== */\n'.format(prefix))
-        if os.path.exists( custom ):
-            with io.open( custom, 'rt', encoding='utf-8' ) as fin:
-                for line in fin:
-                    fout.write( unicode(line) )
-    os.rename( custom+'-new',custom)
+    # Add the CSS at the beginning of custom.css, in a single write
+    with open(custom_new, 'wb') as fout:
+        fout.write( u'{}START ======================== */\n'.format(prefix).encode('utf-8')
+                    + data
+                    + u'{}END ======================== */\n'.format(prefix).encode('utf-8')
+                    + old )
+    replace( custom_new, custom )
 
 
 def remove_custom_css(destdir, resource=PKGNAME ):
@@ -116,26 +146,19 @@ def remove_custom_css(destdir, resource=PKGNAME ):
     if not os.path.isdir( destdir ):
         return False
     custom = os.path.join( destdir, 'custom.css' )
-    copy = True
-    found = False
-    prefix = css_frame_prefix(resource)
-    with io.open(custom + '-new', 'wt') as fout:
-        with io.open(custom) as fin:
-            for line in fin:
-                if line.startswith( prefix + 'START' ):
-                    copy = False
-                    found = True
-                elif line.startswith( prefix + 'END' ):
-                    copy = True
-                elif copy:
-                    fout.write( line )
+    custom_new = custom + '-new'
+    if not os.path.exists( custom ):
+        return False
+    with open( custom, 'rb' ) as fin:
+        data, found = strip_css_frame( fin.read(), css_frame_prefix(resource) )
 
+    # Rewrite the file only if there was something to remove
     if found:
-        os.rename( custom+'-new',custom)
-    else:
-        os.unlink( custom+'-new')
+        with open(custom_new, 'wb') as fout:
+            fout.write( data )
+        replace( custom_new, custom )
 
-    return found
+    return found > 0
 
 
 
@@ -177,8 +200,14 @@ class SparqlKernelInstall( InstallKernelSpec ):
             # Add kernel spec
             if len(self.logdir):
                 kernel_json['env'] = { 'LOGDIR_DEFAULT' : self.logdir }
-            with open(os.path.join(td, 'kernel.json'), 'w') as f:
-                json.dump(kernel_json, f, sort_keys=True)
+            kernel_file = os.path.join(td, 'kernel.json')
+            if orjson:
+                with open(kernel_file, 'wb') as f:
+                    f.write(orjson.dumps(kernel_json,
+                                         option=orjson.OPT_SORT_KEYS))
+            else:
+                with open(kernel_file, 'w') as f:
+                    json.dump(kernel_json, f, sort_keys=True)
             # Add resources
             install_kernel_resources(td, resource=PKGNAME)
             # Install JSON kernel specification + resources
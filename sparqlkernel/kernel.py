@@ -4,6 +4,7 @@ Interact with the notebook and process all frontend requests.
 """
 
 import logging
+from bisect import bisect_left
 
 from ipykernel.kernelbase import Kernel
 from traitlets import List
@@ -13,9 +14,9 @@ import SPARQLWrapper
 from .constants import __version__, LANGUAGE
 from .utils import data_msg
 from .setlogging import set_logging
-from .language import sparql_names, sparql_help
+from .language import sparql_names, sparql_names_sorted, sparql_help_ci
 from .connection import SparqlConnection
-from .magics import split_lines, process_magic, MAGICS, MAGIC_HELP
+from .magics import process_magic, MAGICS, MAGIC_NAMES, magic_help
 
 # IPython.core.display.HTML
 
@@ -50,6 +51,40 @@ def token_at_cursor(code, pos=0):
     return code[start:end], start
 
 
+def split_magics(code):
+    """
+    Separate the magic lines at the beginning of a cell from the SPARQL query
+    that follows them, which is returned as a slice of the original buffer.
+    Empty lines and comments before the query are skipped
+     :return (tuple): a pair (magic_lines, query)
+    """
+    magic_lines = []
+    start = 0
+    while start < len(code):
+        end = code.find('\n', start)
+        if end == -1:
+            end = len(code)
+        line = code[start:end].strip()
+        if line and line[0] != '#':
+            if line[0] != '%':
+                return magic_lines, code[start:]
+            magic_lines.append(line)
+        start = end + 1
+    return magic_lines, ''
+
+
+def prefix_matches(names, prefix):
+    """
+    Find all names starting with a prefix, by binary search
+     :param names (list): a sorted list of names
+     :return (list): the matching names
+    """
+    start = end = bisect_left(names, prefix)
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return names[start:end]
+
+
 # --------------------------------------------------------------------------
 
 class SparqlKernel(Kernel):
@@ -114,11 +149,12 @@ class SparqlKernel(Kernel):
         """
         # Data to send back
         if data is not None:
-            # log the message
-            try:
-                self._klog.debug(u"msg to frontend (%d): %.160s...", silent, data)
-            except Exception as e:
-                self._klog.warn(u"can't log response: %s", e)
+            # log the message (only if it will be output)
+            if self._klog.isEnabledFor(logging.DEBUG):
+                try:
+                    self._klog.debug(u"msg to frontend (%d): %.160s...", silent, data)
+                except Exception as e:
+                    self._klog.warning(u"can't log response: %s", e)
             # send it to the frontend
             if not silent:
                 if msg_type != 'raw':
@@ -142,28 +178,20 @@ class SparqlKernel(Kernel):
         """
         self._klog.info("[%.30s] [%d] [%s]", code, silent, user_expressions)
 
-        # Split lines and remove empty lines & comments
-        code_noc = split_lines(code)
-        if not code_noc:
+        # Separate the magics from the query, skipping empty lines & comments
+        magic_lines, query = split_magics(code)
+        if not (magic_lines or query):
             return self._send(None)
 
         # Process
         try:
-            # Detect if we've got magics
-            magic_lines = []
-            for line in code_noc:
-                if line[0] != '%':
-                    break
-                magic_lines.append(line)
-
-            # Process magics. Once done, remove them from the query buffer
+            # Process magics
             if magic_lines:
                 out = [process_magic(line, self._k.cfg) for line in magic_lines]
                 self._send(out, 'multi', silent=silent)
-                code = '\n'.join(code_noc[len(magic_lines):])
 
             # If we have a regular SPARQL query, process it now
-            result = self._k.query(code, num=self.execution_count) if code else None
+            result = self._k.query(query, num=self.execution_count) if query else None
 
             # Return the result
             return self._send(result, 'raw', silent=silent)
@@ -186,9 +214,9 @@ class SparqlKernel(Kernel):
 
         # Find the help for this token
         if not is_magic(token, start, code):
-            info = sparql_help.get(token.upper(), None)
+            info = sparql_help_ci.get(token.lower(), None)
         elif token == '%':
-            info = MAGIC_HELP
+            info = magic_help()
         else:
             info = MAGICS.get(token, None)
             if info:
@@ -211,10 +239,10 @@ class SparqlKernel(Kernel):
         token, start = token_at_cursor(code, cursor_pos)
         tkn_low = token.lower()
         if is_magic(token, start, code):
-            matches = [k for k in MAGICS.keys() if k.startswith(tkn_low)]
+            matches = prefix_matches(MAGIC_NAMES, tkn_low)
         else:
-            matches = [sparql_names[k] for k in sparql_names
-                       if k.startswith(tkn_low)]
+            matches = [sparql_names[k]
+                       for k in prefix_matches(sparql_names_sorted, tkn_low)]
         self._klog.debug("token={%s} matches={%r}", token, matches)
 
         if matches:
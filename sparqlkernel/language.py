@@ -2,8 +2,6 @@
 SPARQL language catalogs
 """
 
-from itertools import chain
-
 
 # ------------------------------------------------------------------------
 
@@ -37,9 +35,10 @@ sparql_operators = ['bound', 'isIRI', 'isBlank', 'isLiteral',
 
 
 # All SPARQL reserved words
-sparql_names = dict( ((k.lower(),k) for k in 
-                      chain.from_iterable( (sparql_keywords, sparql_operators))
-                  ) )
+sparql_names = {k.lower(): k for k in sparql_keywords + sparql_operators}
+
+# Sorted list of the reserved words, in lowercase (for prefix searches)
+sparql_names_sorted = sorted(sparql_names)
 
 # ------------------------------------------------------------------------
 
@@ -110,3 +109,6 @@ r'''Puts an upper bound on the number of solutions returned.
 
 LIMIT Integer''',
 }
+
+# The same help, keyed by lowercase keyword
+sparql_help_ci = {k.lower(): v for k, v in sparql_help.items()}
@@ -2,13 +2,12 @@
 import os
 import os.path
 import io
-from operator import itemgetter
 import logging
 
 import SPARQLWrapper
 
 from .constants import DEFAULT_TEXT_LANG
-from .utils import KrnlException, is_collection
+from .utils import KrnlException, is_collection, memoize
 
 
 # Maximum number of nestes magic files
@@ -40,12 +39,20 @@ MAGICS = {
 }
 
 
-# The full list of all magics
-MAGIC_HELP = ('Available magics:\n' +
-              '  '.join(sorted(MAGICS.keys())) +
-              '\n\n' +
-              '\n'.join(('{0} {1} : {2}'.format(k, *v)
-                         for k, v in sorted(MAGICS.items(), key=itemgetter(0)))))
+# The full list of all magics, sorted
+MAGIC_NAMES = sorted(MAGICS)
+
+
+@memoize(1)
+def magic_help():
+    '''
+    Return the help text for all magics, built on first use
+    '''
+    return ('Available magics:\n' +
+            '  '.join(MAGIC_NAMES) +
+            '\n\n' +
+            '\n'.join(['{0} {1} : {2}'.format(k, *MAGICS[k])
+                       for k in MAGIC_NAMES]))
 
 
 # -----------------------------------------------------------------------------
@@ -55,10 +62,205 @@ def split_lines(buf):
     Split a buffer in lines, skipping emtpy lines and commend lines, and
     stripping whitespace at the beginning or end of lines
     '''
-    return [line for line in map(lambda x: x.strip(), buf.split('\n'))
-            if line and line[0] != '#']
+    lines = (line.strip() for line in buf.split('\n'))
+    return [line for line in lines if line and line[0] != '#']
+
+
+# -----------------------------------------------------------------------------
+# Magic handlers. Each one gets the magic parameters and the configuration
+# object, and returns the (output-message,css-class) tuple for the magic
+
+def _mg_endpoint(param, cfg):
+    cfg.ept = param
+    return ['Endpoint set to: {}', param], 'magic'
+
+
+def _mg_auth(param, cfg):
+    auth_data = param.split(None, 2)
+    if auth_data[0].lower() == 'none':
+        cfg.aut = None
+        return ['HTTP authentication: None'], 'magic'
+    if auth_data and len(auth_data) != 3:
+        raise KrnlException("invalid %auth magic")
+    try:
+        auth_data = [os.environ[v[4:]] if v.startswith(('env:', 'ENV:')) else v
+                     for v in auth_data]
+    except KeyError as e:
+        raise KrnlException("cannot find environment variable: {}", e)
+    cfg.aut = auth_data
+    return ['HTTP authentication: method={}, user={}, passwd set',
+            auth_data[0], auth_data[1]], 'magic'
+
+
+def _mg_qparam(param, cfg):
+    v = param.split(None, 1)
+    if len(v) == 0:
+        raise KrnlException("missing %qparam name")
+    elif len(v) == 1:
+        cfg.par.pop(v[0], None)
+        return ['Param deleted: {}', v[0]], 'magic'
+    else:
+        cfg.par[v[0]] = v[1]
+        return ['Param set: {} = {}'] + v, 'magic'
+
+
+def _mg_http_header(param, cfg):
+    v = param.split(None, 1)
+    if len(v) == 0:
+        raise KrnlException("missing %http_header name")
+    elif len(v) == 1:
+        try:
+            del cfg.hhr[v[0]]
+            return ['HTTP header deleted: {}', v[0]], 'magic'
+        except KeyError:
+            return ['Not-existing HTTP header: {}', v[0]], 'magic'
+    else:
+        cfg.hhr[v[0]] = v[1]
+        return ['HTTP header set: {} = {}'] + v, 'magic'
+
+
+def _mg_prefix(param, cfg):
+    v = param.split(None, 1)
+    cfg.pfb = None
+    if len(v) == 0:
+        raise KrnlException("missing %prefix value")
+    elif len(v) == 1:
+        cfg.pfx.pop(v[0], None)
+        return ['Prefix deleted: {}', v[0]], 'magic'
+    else:
+        cfg.pfx[v[0]] = v[1]
+        return ['Prefix set: {} = {}'] + v, 'magic'
+
+
+def _mg_show(param, cfg):
+    if param == 'all':
+        cfg.lmt = None
+    else:
+        try:
+            cfg.lmt = int(param)
+        except ValueError as e:
+            raise KrnlException("invalid result limit: {}", e)
+    sz = cfg.lmt if cfg.lmt is not None else 'unlimited'
+    return ['Result maximum size: {}', sz], 'magic'
+
+
+# The result formats accepted by %format
+_FMT_LIST = {'JSON': SPARQLWrapper.JSON,
+             'N3': SPARQLWrapper.N3,
+             'XML': SPARQLWrapper.XML,
+             'RDF': SPARQLWrapper.RDF,
+             'NONE': None,
+             'DEFAULT': True,
+             'ANY': False}
 
 
+def _mg_format(param, cfg):
+    try:
+        fmt = param.upper()
+        cfg.fmt = _FMT_LIST[fmt]
+    except KeyError:
+        raise KrnlException('unsupported format: {}\nSupported formats are: {!s}', param, list(_FMT_LIST.keys()))
+    return ['Request format: {}', fmt], 'magic'
+
+
+def _mg_lang(param, cfg):
+    cfg.lan = DEFAULT_TEXT_LANG if param == 'default' else [] if param == 'all' else param.split()
+    return ['Label preferred languages: {}', cfg.lan], 'magic'
+
+
+def _mg_graph(param, cfg):
+    cfg.grh = param if param else None
+    return ['Default graph: {}', param if param else 'None'], 'magic'
+
+
+def _mg_display(param, cfg):
+    v = param.lower().split(None, 2)
+    if len(v) == 0 or v[0] not in ('table', 'raw', 'graph', 'diagram'):
+        raise KrnlException('invalid %display command: {}', param)
+
+    msg_extra = ''
+    if v[0] not in ('diagram', 'graph'):
+        cfg.dis = v[0]
+        cfg.typ = len(v) > 1 and v[1].startswith('withtype')
+        if cfg.typ and cfg.dis == 'table':
+            msg_extra = '\nShow Types: on'
+    elif len(v) == 1:   # graph format, defaults
+        cfg.dis = ['svg']
+    else:               # graph format, with options
+        if v[1] not in ('png', 'svg'):
+            raise KrnlException('invalid graph format: {}', param)
+        if len(v) > 2:
+            if not v[2].startswith('withlit'):
+                raise KrnlException('invalid graph option: {}', param)
+            msg_extra = '\nShow literals: on'
+        cfg.dis = v[1:3]
+
+    display = cfg.dis[0] if is_collection(cfg.dis) else cfg.dis
+    return ['Display: {}{}', display, msg_extra], 'magic'
+
+
+def _mg_outfile(param, cfg):
+    if param in ('NONE', 'OFF'):
+        cfg.out = None
+        return ['no output file'], 'magic'
+    else:
+        cfg.out = param
+        return ['Output file: {}', os.path.abspath(param)], 'magic'
+
+
+def _mg_log(param, cfg):
+    if not param:
+        raise KrnlException('missing log level')
+    try:
+        lev = param.upper()
+        parent_logger = logging.getLogger(__name__.rsplit('.', 1)[0])
+        parent_logger.setLevel(lev)
+        return ("Logging set to {}", lev), 'magic'
+    except ValueError:
+        raise KrnlException('unknown log level: {}', param)
+
+
+def _mg_header(param, cfg):
+    if param.upper() == 'OFF':
+        num = len(cfg.hdr)
+        cfg.hdr = []
+        return ['All headers deleted ({})', num], 'magic'
+    else:
+        if param in cfg.hdr:
+            return ['Header skipped (repeated)'], 'magic'
+        cfg.hdr.append(param)
+        return ['Header added: {}', param], 'magic'
+
+
+def _mg_method(param, cfg):
+    method = param.upper()
+    if method not in ('GET', 'POST'):
+        raise KrnlException('invalid HTTP method: {}', param)
+    cfg.mth = method
+    return ['HTTP method: {}', method], 'magic'
+
+
+# Map magic names to their handlers
+_MAGIC_HANDLERS = {
+    'endpoint': _mg_endpoint,
+    'auth': _mg_auth,
+    'qparam': _mg_qparam,
+    'http_header': _mg_http_header,
+    'prefix': _mg_prefix,
+    'show': _mg_show,
+    'format': _mg_format,
+    'lang': _mg_lang,
+    'graph': _mg_graph,
+    'display': _mg_display,
+    'outfile': _mg_outfile,
+    'log': _mg_log,
+    'header': _mg_header,
+    'method': _mg_method,
+}
+
+
+# -----------------------------------------------------------------------------
+
 def process_magic(line, cfg, _recurse=0):
     """
     Read and process magics
@@ -73,7 +275,7 @@ def process_magic(line, cfg, _recurse=0):
 
     # The %lsmagic has no parameters
     if line.startswith('%lsmagic'):
-        return MAGIC_HELP, 'magic-help'
+        return magic_help(), 'magic-help'
 
     # Split line into command & parameters
     try:
@@ -82,7 +284,7 @@ def process_magic(line, cfg, _recurse=0):
         raise KrnlException("invalid magic line: {}", line)
     cmd = cmd[1:].lower()
 
-    # Process each magic
+    # Loading a file processes its magics recursively
     if cmd == 'load':
 
         try:
@@ -95,172 +297,10 @@ def process_magic(line, cfg, _recurse=0):
                 raise KrnlException("error in file '{}': non-magic line found: {}",
                                     param, line)
             process_magic(line, cfg, _recurse+1)
+        return
 
-    elif cmd == 'endpoint':
-
-        cfg.ept = param
-        return ['Endpoint set to: {}', param], 'magic'
-
-    elif cmd == 'auth':
-
-        auth_data = param.split(None, 2)
-        if auth_data[0].lower() == 'none':
-            cfg.aut = None
-            return ['HTTP authentication: None'], 'magic'
-        if auth_data and len(auth_data) != 3:
-            raise KrnlException("invalid %auth magic")
-        try:
-            auth_data = [os.environ[v[4:]] if v.startswith(('env:', 'ENV:')) else v
-                         for v in auth_data]
-        except KeyError as e:
-            raise KrnlException("cannot find environment variable: {}", e)
-        cfg.aut = auth_data
-        return ['HTTP authentication: method={}, user={}, passwd set',
-                auth_data[0], auth_data[1]], 'magic'
-
-    elif cmd == 'qparam':
-
-        v = param.split(None, 1)
-        if len(v) == 0:
-            raise KrnlException("missing %qparam name")
-        elif len(v) == 1:
-            cfg.par.pop(v[0], None)
-            return ['Param deleted: {}', v[0]], 'magic'
-        else:
-            cfg.par[v[0]] = v[1]
-            return ['Param set: {} = {}'] + v, 'magic'
-
-    elif cmd == 'http_header':
-
-        v = param.split(None, 1)
-        if len(v) == 0:
-            raise KrnlException("missing %http_header name")
-        elif len(v) == 1:
-            try:
-                del cfg.hhr[v[0]]
-                return ['HTTP header deleted: {}', v[0]], 'magic'
-            except KeyError:
-                return ['Not-existing HTTP header: {}', v[0]], 'magic'
-        else:
-            cfg.hhr[v[0]] = v[1]
-            return ['HTTP header set: {} = {}'] + v, 'magic'
-
-    elif cmd == 'prefix':
-
-        v = param.split(None, 1)
-        if len(v) == 0:
-            raise KrnlException("missing %prefix value")
-        elif len(v) == 1:
-            cfg.pfx.pop(v[0], None)
-            return ['Prefix deleted: {}', v[0]], 'magic'
-        else:
-            cfg.pfx[v[0]] = v[1]
-            return ['Prefix set: {} = {}'] + v, 'magic'
-
-    elif cmd == 'show':
-
-        if param == 'all':
-            cfg.lmt = None
-        else:
-            try:
-                cfg.lmt = int(param)
-            except ValueError as e:
-                raise KrnlException("invalid result limit: {}", e)
-        sz = cfg.lmt if cfg.lmt is not None else 'unlimited'
-        return ['Result maximum size: {}', sz], 'magic'
-
-    elif cmd == 'format':
-
-        fmt_list = {'JSON': SPARQLWrapper.JSON,
-                    'N3': SPARQLWrapper.N3,
-                    'XML': SPARQLWrapper.XML,
-                    'RDF': SPARQLWrapper.RDF,
-                    'NONE': None,
-                    'DEFAULT': True,
-                    'ANY': False}
-        try:
-            fmt = param.upper()
-            cfg.fmt = fmt_list[fmt]
-        except KeyError:
-            raise KrnlException('unsupported format: {}\nSupported formats are: {!s}', param, list(fmt_list.keys()))
-        return ['Request format: {}', fmt], 'magic'
-
-    elif cmd == 'lang':
-
-        cfg.lan = DEFAULT_TEXT_LANG if param == 'default' else [] if param == 'all' else param.split()
-        return ['Label preferred languages: {}', cfg.lan], 'magic'
-
-    elif cmd in 'graph':
-
-        cfg.grh = param if param else None
-        return ['Default graph: {}', param if param else 'None'], 'magic'
-
-    elif cmd == 'display':
-
-        v = param.lower().split(None, 2)
-        if len(v) == 0 or v[0] not in ('table', 'raw', 'graph', 'diagram'):
-            raise KrnlException('invalid %display command: {}', param)
-
-        msg_extra = ''
-        if v[0] not in ('diagram', 'graph'):
-            cfg.dis = v[0]
-            cfg.typ = len(v) > 1 and v[1].startswith('withtype')
-            if cfg.typ and cfg.dis == 'table':
-                msg_extra = '\nShow Types: on'
-        elif len(v) == 1:   # graph format, defaults
-            cfg.dis = ['svg']
-        else:               # graph format, with options
-            if v[1] not in ('png', 'svg'):
-                raise KrnlException('invalid graph format: {}', param)
-            if len(v) > 2:
-                if not v[2].startswith('withlit'):
-                    raise KrnlException('invalid graph option: {}', param)
-                msg_extra = '\nShow literals: on'
-            cfg.dis = v[1:3]
-
-        display = cfg.dis[0] if is_collection(cfg.dis) else cfg.dis
-        return ['Display: {}{}', display, msg_extra], 'magic'
-
-    elif cmd == 'outfile':
-
-        if param in ('NONE', 'OFF'):
-            cfg.out = None
-            return ['no output file'], 'magic'
-        else:
-            cfg.out = param
-            return ['Output file: {}', os.path.abspath(param)], 'magic'
-
-    elif cmd == 'log':
-
-        if not param:
-            raise KrnlException('missing log level')
-        try:
-            lev = param.upper()
-            parent_logger = logging.getLogger(__name__.rsplit('.', 1)[0])
-            parent_logger.setLevel(lev)
-            return ("Logging set to {}", lev), 'magic'
-        except ValueError:
-            raise KrnlException('unknown log level: {}', param)
-
-    elif cmd == 'header':
-
-        if param.upper() == 'OFF':
-            num = len(cfg.hdr)
-            cfg.hdr = []
-            return ['All headers deleted ({})', num], 'magic'
-        else:
-            if param in cfg.hdr:
-                return ['Header skipped (repeated)'], 'magic'
-            cfg.hdr.append(param)
-            return ['Header added: {}', param], 'magic'
-
-    elif cmd == 'method':
-
-        method = param.upper()
-        if method not in ('GET', 'POST'):
-            raise KrnlException('invalid HTTP method: {}', param)
-        cfg.mth = method
-        return ['HTTP method: {}', method], 'magic'
-
-    else:
+    # Process all other magics
+    handler = _MAGIC_HANDLERS.get(cmd)
+    if handler is None:
         raise KrnlException("magic not found: {}", cmd)
+    return handler(param, cfg)
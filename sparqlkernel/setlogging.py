@@ -4,12 +4,14 @@ Install a logging configuration for kernel modules
 
 
 from logging.config import dictConfig
+from copy import deepcopy
 import tempfile
 import os.path
 
 
 # ----------------------------------------------------------------------
 
+# The default configuration. It is used as a template, and never modified
 LOGCONFIG = {
     'version' : 1,
     'formatters' : {
@@ -45,6 +47,13 @@ LOGCONFIG = {
 }
 
 
+# Default basename for the logfile: the package name
+LOG_BASENAME = __name__.rsplit('.', 2)[-2] if '.' in __name__ else __name__
+
+# The (logfile, level) pair of the last applied configuration
+_configured = None
+
+
 # ----------------------------------------------------------------------
 
 def set_logging( logfilename=None, level=None ):
@@ -55,18 +64,24 @@ def set_logging( logfilename=None, level=None ):
     The default logfile is \c sparqlkernel.log, placed in the directory given
     by (in that order) the \c LOGDIR environment variable, the logdir
     specified upon kernel installation or the default temporal directory.
+    The configuration is not applied again if it has not changed.
     """
+    global _configured
     if logfilename is None:
         # Find the logging diectory
         logdir = os.environ.get( 'LOGDIR' )
         if logdir is None:
             logdir = os.environ.get( 'LOGDIR_DEFAULT', tempfile.gettempdir() )
         # Define the log filename
-        basename = __name__.split('.')[-2]
-        logfilename = os.path.join( logdir, basename + '.log' )
-    LOGCONFIG['handlers']['default']['filename'] = logfilename
+        logfilename = os.path.join( logdir, LOG_BASENAME + '.log' )
+    key = (logfilename, level)
+    if _configured == key:
+        return
+    config = deepcopy( LOGCONFIG )
+    config['handlers']['default']['filename'] = logfilename
 
     if level is not None:
-        LOGCONFIG['loggers']['sparqlkernel']['level'] = level
+        config['loggers']['sparqlkernel']['level'] = level
 
-    dictConfig( LOGCONFIG )
+    dictConfig( config )
+    _configured = key
@@ -4,6 +4,7 @@ Miscellaneous utility functions
 
 import sys
 import logging
+from functools import wraps
 LOG = logging.getLogger(__name__)
 
 if sys.version_info[0] > 2:
@@ -11,19 +12,44 @@ if sys.version_info[0] > 2:
 
 # Default wrapping class for an output message
 HTML_DIV_CLASS = 'krn-spql'
+# The wrapping element for an output message, ready to be concatenated
+HTML_DIV_START = u'<div class="%s">' % HTML_DIV_CLASS
+HTML_DIV_END = u'</div>'
 
 
 # ----------------------------------------------------------------
 
 def is_collection(v):
     """
-    Decide if a variable contains multiple values and therefore can be
-    iterated, discarding strings (single strings can also be iterated, but
-    shouldn't qualify)
+    Decide if a variable contains multiple values, i.e. it is a list or a
+    tuple (strings can also be iterated, but shouldn't qualify). All callers
+    index the value, so other iterables do not qualify either
     """
-    # The 2nd clause is superfluous in Python 2, but (maybe) not in Python 3
-    # Therefore we use 'str' instead of 'basestring'
-    return hasattr(v, '__iter__') and not isinstance(v, str)
+    return isinstance(v, (list, tuple))
+
+
+def memoize(maxsize):
+    """
+    Decorator caching the results of a function called with hashable
+    positional arguments. A minimal replacement for functools.lru_cache,
+    which is not available in Python 2: when full, the cache is emptied
+      @param maxsize (int): the maximum number of cached results
+    """
+    def decorator(func):
+        cache = {}
+
+        @wraps(func)
+        def wrapper(*args):
+            try:
+                return cache[args]
+            except KeyError:
+                pass
+            if len(cache) >= maxsize:
+                cache.clear()
+            result = cache[args] = func(*args)
+            return result
+        return wrapper
+    return decorator
 
 
 
@@ -40,17 +66,30 @@ def escape(x, lb=False):
         tl = len(x)
         if tl >= 10:
             tl >>= 1                   # middle of the string
-            s1 = x.find(' ', tl)       # first ws to the right
-            s2 = x.rfind(' ', 0, tl)   # first ws to the left
-            if s2 > 0:
-                s = s2 if s1 < 0 or tl-s1 > s2-tl else s1
+            s = x.rfind(' ', 0, tl)    # first ws to the left
+            if s > 0:
+                # first ws to the right, only if not farther away
+                s1 = x.find(' ', tl, 2*tl - s + 1)
+            else:
+                s1 = x.find(' ', tl)
+            if s1 >= 0:
+                s = s1
+            if s > 0:
                 x = x[:s] + '\\n' + x[s+1:]
-            elif s1 > 0:
-                x = x[:s1] + '\\n' + x[s1+1:]
     # Escape HTML reserved characters
     return x.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
 
 
+def escape_many(values):
+    """
+    HTML-escape a list of strings, in a single pass over all of them.
+    Joining them first amortizes the per-call cost across the whole batch
+    """
+    escaped = escape(u'\x00'.join(values)).split(u'\x00')
+    # A string containing the separator: fall back to one at a time
+    return escaped if len(escaped) == len(values) else [escape(v) for v in values]
+
+
 # ----------------------------------------------------------------------
 
 def div(txt, *args, **kwargs):
@@ -65,7 +104,16 @@ def div(txt, *args, **kwargs):
     if args:
         txt = txt.format(*args)
     css = kwargs.get('css', HTML_DIV_CLASS)
-    return u'<div class="{}">{!s}</div>'.format(css, txt)
+    return u'<div class="%s">%s</div>' % (css, txt)
+
+
+@memoize(512)
+def _fmt_html(msg):
+    '''
+    Escape a message and convert its linebreaks to HTML. Kernel messages
+    repeat a lot across cells, so results are cached
+    '''
+    return escape(msg).replace('\n', '<br/>')
 
 
 def data_msglist(msglist):
@@ -79,17 +127,23 @@ def data_msglist(msglist):
     Each message is either a text string, or a list. In the latter case it is
     assumed to be a format string + parameters.
     """
-    txt = html = u''
+    html = []
+    txt = []
     for msg, css in msglist:
         if is_collection(msg):
             msg = msg[0].format(*msg[1:])
-        html += div(escape(msg).replace('\n', '<br/>'), css=css or 'msg')
-        txt += msg + "\n"
-    return {'data': {'text/html': div(html),
-                     'text/plain': txt},
+        html.append(div(_fmt_html(msg), css=css or 'msg'))
+        txt.append(msg)
+        txt.append(u'\n')
+    return {'data': {'text/html': HTML_DIV_START + u''.join(html) + HTML_DIV_END,
+                     'text/plain': u''.join(txt)},
             'metadata': {}}
 
 
+# The types of the plain (non-exception) messages
+MSG_TYPES = frozenset((str, unicode, list, tuple))
+
+
 def data_msg(msg, mtype=None):
     """
     Return a Jupyter display_data message, in both HTML & text formats, by
@@ -105,11 +159,13 @@ def data_msg(msg, mtype=None):
         not passed, \c krn-error will be used for exceptions and \c msg for
         everything else
     """
-    if isinstance(msg, KrnlException):
-        return msg()    # a KrnlException knows how to format itself
-    elif isinstance(msg, Exception):
-        return KrnlException(msg)()
-    elif mtype == 'multi':
+    # Plain messages go straight to formatting; only others can be exceptions
+    if type(msg) not in MSG_TYPES:
+        if isinstance(msg, KrnlException):
+            return msg()    # a KrnlException knows how to format itself
+        elif isinstance(msg, Exception):
+            return KrnlException(msg)()
+    if mtype == 'multi':
         return data_msglist(msg)
     else:
         return data_msglist([(msg, mtype)])
@@ -125,7 +181,7 @@ class KrnlException(Exception):
     to be sent to the frontend.
     """
     def __init__(self, msg, *args):
-        if len(args):
+        if args:
             try:
                 msg = msg.format(*args)
             except UnicodeError:
@@ -133,20 +189,26 @@ class KrnlException(Exception):
         elif isinstance(msg, Exception):
             msg = repr(msg)
         super(KrnlException, self).__init__(msg)
-        LOG.warn('KrnlException: %s', self, exc_info=1)
+        self._rendered = None
+        if LOG.isEnabledFor(logging.WARNING):
+            LOG.warning('KrnlException: %s', self, exc_info=1)
 
     def __call__(self):
         """
-        Generate a Jupyter data message
+        Generate a Jupyter data message. The message does not change, so it
+        is generated only once
         """
+        if self._rendered is not None:
+            return self._rendered
         try:
             msg = self.args[0]
             html = div(div('<span class="title">Error:</span> ' +
                            escape(msg).replace('\n', '<br/>'),
                            css="krn-error"))
-            return {'data': {'text/html': html,
-                             'text/plain': 'Error: ' + msg},
-                    'metadata': {}}
+            self._rendered = {'data': {'text/html': html,
+                                       'text/plain': 'Error: ' + msg},
+                              'metadata': {}}
+            return self._rendered
         except Exception as e:
-            return {'data': {'text/plain': u'Error: ' + unicode(repr(e))},
+            return {'data': {'text/plain': u'Error: ' + repr(e)},
                     'metadata': {}}
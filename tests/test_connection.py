@@ -0,0 +1,97 @@
+"""
+Tests for the result processing functions in sparqlkernel.connection
+"""
+
+import unittest
+
+from rdflib import ConjunctiveGraph, Literal, Namespace, URIRef
+from rdflib.namespace import XSD
+
+from sparqlkernel.connection import lang_filter_query, lang_match_json, \
+    render_graph, CfgStruct
+from sparqlkernel.utils import KrnlException
+
+
+EX = Namespace('http://example.org/')
+
+
+class TestLangFilterQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.g = ConjunctiveGraph()
+        self.g.add((EX.a, EX.p, Literal('hello', lang='en')))
+        self.g.add((EX.b, EX.p, Literal('hola', lang='es')))
+        self.g.add((EX.c, EX.p, Literal('plain')))
+        self.g.add((EX.d, EX.p, Literal(42, datatype=XSD.integer)))
+        self.g.add((EX.e, EX.p, URIRef('http://example.org/x')))
+
+    def subjects(self, query):
+        res = self.g.query(query)
+        return set(str(r[0]) for r in res)
+
+    def test_untagged_literals_kept(self):
+        query = 'SELECT ?s ?o WHERE { ?s ?p ?o }'
+        rewritten = lang_filter_query(query, ['en'])
+        self.assertIsNotNone(rewritten)
+        self.assertEqual(self.subjects(rewritten),
+                         set(str(EX[n]) for n in 'acde'))
+
+    def test_superset_of_client_filter(self):
+        # Rows as delivered by Virtuoso, which uses "typed-literal"
+        hdr = ['s', 'o']
+        rows = [{'s': {'type': 'uri', 'value': EX.d},
+                 'o': {'type': 'typed-literal', 'value': '42',
+                       'datatype': str(XSD.integer)}},
+                {'s': {'type': 'uri', 'value': EX.a},
+                 'o': {'type': 'literal', 'value': 'hello', 'xml:lang': 'en'}},
+                {'s': {'type': 'uri', 'value': EX.b},
+                 'o': {'type': 'literal', 'value': 'hola', 'xml:lang': 'es'}}]
+        client = set(str(r['s']['value']) for r in rows
+                     if lang_match_json(r, hdr, ['en']))
+        self.assertEqual(client, set([str(EX.a), str(EX.d)]))
+        rewritten = lang_filter_query('SELECT ?s ?o WHERE { ?s ?p ?o }',
+                                      ['en'])
+        self.assertTrue(client <= self.subjects(rewritten))
+
+    def test_not_rewritten(self):
+        self.assertIsNone(lang_filter_query('SELECT * WHERE { ?s ?p ?o }',
+                                            ['en']))
+        self.assertIsNone(lang_filter_query('SELECT ?s WHERE { ?s ?p ?o }',
+                                            ['en") || true || ("']))
+
+
+class TestRenderGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = CfgStruct(dis='raw', lan=[], typ=False, lmt=20)
+
+    def render(self, body):
+        return render_graph(body, self.cfg, format='text/turtle')['data']
+
+    def test_raw_prefix_only(self):
+        body = (b'@prefix ex: <http://example.org/> .\n'
+                b'PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>\n'
+                b'# no results\n\n')
+        data = self.render(body)
+        self.assertNotIn('text/plain', data)
+        self.assertIn('empty graph', data['text/html'])
+
+    def test_raw_prefix_and_statement_in_one_line(self):
+        body = b'@prefix ex: <http://e/> . ex:a ex:b ex:c .'
+        self.assertEqual(self.render(body), {'text/plain': body.decode()})
+
+    def test_raw_blank(self):
+        self.assertIn('text/html', self.render(b'  \n'))
+
+    def test_raw_statements(self):
+        body = (b'@prefix ex: <http://example.org/> .\n'
+                b'ex:a ex:p "hello"@en .\n')
+        self.assertEqual(self.render(body), {'text/plain': body.decode()})
+
+    def test_unsupported_format(self):
+        self.assertRaises(KrnlException, render_graph, b'', self.cfg,
+                          format='text/csv')
+
+
+if __name__ == '__main__':
+    unittest.main()